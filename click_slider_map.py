@@ -1,14 +1,17 @@
+import functools
+import re
 import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objs as go
-from dash import Dash, dcc, html, Input, Output
+from dash import Dash, dcc, html, Input, Output, Patch
 import dash_bootstrap_components as dbc
+from flask_caching import Cache
 from millify import millify
 
 
-def try_millify(x, precision):
-    ''' Try to millify a number, if it fails return the number
+@functools.lru_cache(maxsize=4096)
+def _millify_cached(x, precision):
+    ''' Millify a number, caching the result for repeated inputs
     args.
         x: number to millify
         precision: number of decimal places to round to
@@ -21,8 +24,32 @@ def try_millify(x, precision):
         return x
 
 
+def try_millify(x, precision):
+    ''' Try to millify a number, if it fails return the number
+    args.
+        x: number to millify
+        precision: number of decimal places to round to
+    returns.
+        millified number or original number
+    '''
+    # missing values can't be millified, skip them before the cache
+    if isinstance(x, (int, float, np.number)) and not pd.isna(x):
+        return _millify_cached(x, precision)
+    return x
+
+
 # Load the data
-data = pd.read_csv("household_data.csv")
+# only parse the columns used by the issues, with the multithreaded pyarrow reader
+keep_cols = pd.read_csv("household_data.csv", nrows=0).filter(regex='wat|san|hyg|gdp|iso3|year|country').columns
+data = pd.read_csv("household_data.csv", engine='pyarrow', usecols=list(keep_cols))
+
+# compact dtypes: category codes for countries, small ints for years, float32 for values
+data = data.astype({'iso3': 'category', 'country': 'category', 'year': 'int16'})
+float_cols = data.select_dtypes('float').columns
+data[float_cols] = data[float_cols].apply(pd.to_numeric, downcast='float')
+
+# GDP is mapped on a log scale, compute it once
+gdp_log10 = np.log10(data['gdp'].to_numpy())
 
 # create sub dataframes filtered by column with titles anc colors
 issue = {
@@ -32,6 +59,99 @@ issue = {
     'gdp': (data.filter(regex='gdp|iso3|year|country', axis=1), 'GDP', 'Greens')
 }
 
+
+# year sorted row positions of each country, shared by all the issue dataframes
+year_arr = data['year'].to_numpy()
+iso_rows = {iso: rows[np.argsort(year_arr[rows], kind='stable')]
+            for iso, rows in data.groupby('iso3', observed=True).indices.items()}
+
+# split the issue dataframes into per-country frames sorted by year for fast lookups on map clicks
+issue_by_iso = {}
+for key, params in issue.items():
+    issue_by_iso[key] = {}
+    for iso, rows in iso_rows.items():
+        issue_by_iso[key][iso] = (params[0].take(rows).reset_index(drop=True), year_arr[rows])
+
+
+def prep_map_data(value):
+    ''' Build the display data for an issue's map, leaving the issue dataframe untouched
+    args.
+        value: key of the issue dictionary
+    returns.
+        tuple of (issue dataframe, title, colors, value column, context, color array, display array)
+    '''
+    issue_df, title, colors = issue[value]
+
+    # format the display data
+    val = issue_df.columns[3]
+    # millify each unique value once and map the results back onto the rows,
+    # adding 0.0 folds -0.0 into 0.0 since the lookup can't tell the two zeros apart
+    arr = issue_df[val].to_numpy() + 0.0
+    lut = {v: try_millify(v, 5) for v in pd.unique(arr)}
+    display = pd.Series(arr).map(lut).to_numpy()
+
+    # color GDP by its precomputed log scale
+    color = gdp_log10 if val == 'gdp' else issue_df[val].to_numpy()
+    context = 'Cov.%' if value != 'gdp' else '$'
+
+    return issue_df, title, colors, val, context, color, display
+
+
+# precompute the map display data once so callbacks only read it
+map_issue = {key: prep_map_data(key) for key in issue}
+
+
+def map_figure(value):
+    """ builds the map figure for an issue
+
+        parameters:
+            value (string): the issue to map
+
+        returns:
+            fig (plot): map of world
+
+    """
+    # parse value to get the precomputed display data
+    issue_df, title, colors, val, context, color, display = map_issue[value]
+    country = issue_df['country'].to_numpy()
+    iso3 = issue_df['iso3'].to_numpy()
+
+    # make the map
+    fig = go.Figure(go.Choropleth(
+        locations=iso3,
+        z=color,
+        hovertext=country,
+        colorscale=colors,
+        colorbar=dict(title=f'{title} {context}'),
+        hovertemplate='<b>%{hovertext}</b><br><br>Country Code=%{location}<br>' + f'{title} {context}' + '=%{z}<extra></extra>',
+    ))
+
+    # set projection, margins and title
+    fig.update_layout(
+        geo=dict(projection_type='natural earth', scope='world'),
+        height=400,
+        margin=dict(l=30, r=30, t=60, b=0),
+        title=dict(text=f"<b>World {title} Coverage Map</b>", font=dict(size=24), yref='paper'),
+        title_x=0.5,
+    )
+
+    # gdp specific formatting, the hover shows the millified value from customdata
+    if value == 'gdp':
+        fig.update_traces(
+            customdata=np.column_stack([country, display, iso3]),
+            colorbar=dict(
+                title=f'{title} {context}',
+                x=1,
+                tickvals=[8, 9, 10, 11, 12, 13],
+                ticktext=['100M', '1B', '10B', '100B', '1T', '10T']),
+            hovertemplate='<b>%{customdata[0]}</b><br>' + 'Country Code: %{customdata[2]}<br>' + f'{title} {context}:' + '%{customdata[1]}'
+        )
+    return fig
+
+
+# build each issue's map once, the callback only sends the parts that differ
+map_figs = {key: map_figure(key) for key in issue}
+
 # dictionary of column names by service
 services = {
     'baseline': ['bas', 'lim', 'unimp', 'sur', 'nfac', 'od'],
@@ -39,6 +159,9 @@ services = {
     'infrastructure': ['pip', 'npip', 'lat', 'sep', 'sew'],
 }
 
+# one compiled pattern per service level matching any of its column names
+SERV_RE = {k: re.compile('|'.join(map(re.escape, v))) for k, v in services.items()}
+
 # remap service level names to more readable names
 service_map = {
     'bas': 'Basic',
@@ -62,9 +185,7 @@ service_map = {
 }
 
 # dict for slider labels
-year_dict = {}
-for i in range(2000, 2020, 1):
-    year_dict[i] = str(i)
+year_dict = {i: str(i) for i in range(2000, 2020)}
 
 # create dropdown options for filters
 drop_ops = {
@@ -76,6 +197,26 @@ drop_ops = {
                        {'label': 'Rural', 'value': '_r'}],
 }
 
+# precompute the line chart columns and the readable names of the plotted
+# series for each issue, service level and residence type
+COL_CACHE = {}
+Y_CACHE = {}
+for iss, (iss_df, _, _) in issue.items():
+    COL_CACHE[iss] = {}
+    Y_CACHE[iss] = {}
+    for ser_lev, serv_re in SERV_RE.items():
+        COL_CACHE[iss][ser_lev] = {}
+        Y_CACHE[iss][ser_lev] = {}
+        for res_type in [op['value'] for op in drop_ops['Residence Type']]:
+            if iss != 'gdp':
+                mask = iss_df.columns.str.contains(serv_re) & iss_df.columns.str.endswith(res_type)
+                cols = ['iso3', 'year', 'country'] + list(iss_df.columns[mask])
+            else:
+                cols = list(iss_df.columns)
+            COL_CACHE[iss][ser_lev][res_type] = cols
+            rename = {col: service_map[k] for col in cols for k in service_map if k in col}
+            Y_CACHE[iss][ser_lev][res_type] = tuple(rename.get(col, col) for col in cols[3:])
+
 # define styling
 SIDEBAR_STYLE = {
     "position": "fixed",
@@ -93,18 +234,8 @@ CONTENT_STYLE = {
     "padding": "0rem 1rem",
 }
 
-# Create the map figure
-map_fig = px.choropleth(
-    data_frame=data,
-    locations="iso3",
-    color="wat_bas_n",
-    hover_name="country",
-    projection="natural earth",
-    title="World Water Coverage by Country",
-    color_continuous_scale='Blues',
-    scope='world',
-    height=400,
-)
+# Create the map figure, starting on the default issue
+map_fig = map_figs['water']
 
 # Create the line chart figure
 line_fig = go.Figure()
@@ -112,6 +243,9 @@ line_fig = go.Figure()
 # Define the app
 app = Dash(external_stylesheets=[dbc.themes.LUX])
 
+# server side cache for the figures returned by the callbacks
+cache = Cache(app.server, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
+
 # define sidebar with filters
 sidebar = html.Div([
     html.H1("Water We Doing?"),
@@ -180,71 +314,94 @@ content = html.Div([
 app.layout = dbc.Container([sidebar, content], fluid=True)
 
 
+@cache.memoize()
+def line_figure(location, iss, ser_lev, res_type, y0, y1):
+    ''' Build the serialized line chart for a country, cached per set of inputs
+
+        Parameters.
+            location (string): iso3 code of the selected country
+            iss (string): the selected issue
+            ser_lev (string): the selected service level
+            res_type (string): the selected residence type
+            y0 (int): first year to display on graph
+            y1 (int): last year to display on graph
+
+        Returns.
+            line_fig (dict): line chart as a figure dictionary
+    '''
+    # get the year sorted data for the selected country
+    country_df, years = issue_by_iso[iss][location]
+    title = issue[iss][1]
+
+    # slice years to be greater than or = min val and less than or = max val
+    start = np.searchsorted(years, y0)
+    stop = np.searchsorted(years, y1, side='right')
+
+    # look up the precomputed columns and their readable names for the selected filters
+    fil_cols = COL_CACHE[iss][ser_lev][res_type]
+    y_cols = Y_CACHE[iss][ser_lev][res_type]
+
+    # build the line chart, only showing the first service,
+    # the rest can be toggled in the legend
+    line_fig = go.Figure()
+    for col, name in zip(fil_cols[3:], y_cols):
+        line_fig.add_trace(go.Scatter(
+            x=years[start:stop],
+            y=country_df[col].to_numpy()[start:stop],
+            name=name,
+            mode='lines',
+            showlegend=True,
+            visible=True if name == y_cols[0] else 'legendonly',
+            hovertemplate=f'variable={name}<br>year=%{{x}}<br>value=%{{y}}<extra></extra>',
+        ))
+
+    # format the line chart
+    line_fig.update_layout(
+        title=f"<b>{country_df['country'].iloc[0]} -- Year by Year</b>",
+        title_x=0.5,
+        height=400,
+        margin=dict(l=30, r=30, t=60, b=0),
+        xaxis_title="Year",
+        yaxis_title="value",
+        legend_title_text="variable",
+    )
+
+    # gdp specific formatting
+    if iss != 'gdp':
+        line_fig.update_layout(
+            yaxis_title=f"{title} Coverage (%)",
+        )
+
+    return line_fig.to_dict()
+
+
 @app.callback(
     Output('map', 'figure'),
-    Input('issue', 'value')
+    Input('issue', 'value'),
+    prevent_initial_call=True
 )
 # Define the app callback for the map
 def make_map(value):
-    """ creates a map of 2020 with the inputted dataframe
+    """ updates the map in place for the selected issue, the country
+        locations and map projection stay the same across issues
 
         parameters:
             value (string): the current issue selected in the dropdown
 
         returns:
-            fig (plot): map of world
+            patch (Patch): the colors, hover data and title of the map
 
     """
-    # parse value to get the correct tuple
-    params = issue[value]
-    issue_df = params[0].copy()
-    title = params[1]
-    colors = params[2]
-
-    # format the display data
-    val = issue_df.columns[3]
-    issue_df[f'{val} '] = issue_df[val].map(lambda x: try_millify(x, precision=5))
-
-    # log scale for GDP and format the display data
-    if val == 'gdp':
-        issue_df[val] = issue_df[val].map(lambda x: np.log10(x))
-    context = 'Cov.%' if value != 'gdp' else '$'
-
-    # make the map
-    fig = px.choropleth(
-        data_frame=issue_df,
-        locations="iso3",
-        color=val,
-        hover_name="country",
-        projection="natural earth",
-        color_continuous_scale=colors,
-        scope="world",
-        height=400,
-        labels={val: f'{title} {context}',
-                'iso3': 'Country Code'},
-        custom_data=['country', val, f'{val} ', 'iso3']
-    )
-
-    # set margins and title
-    fig.update_layout(
-        margin=dict(l=30, r=30, t=60, b=0),
-        title=dict(text=f"<b>World {title} Coverage Map</b>", font=dict(size=24), yref='paper'),
-        title_x=0.5,
-    )
-
-    # gdp specific formatting
-    if value == 'gdp':
-        fig.update_layout(
-            coloraxis_colorbar=dict(
-                title=f'{title} {context}',
-                x=1,
-                tickvals=[8, 9, 10, 11, 12, 13],
-                ticktext=['100M', '1B', '10B', '100B', '1T', '10T']),
-        )
-        fig.update_traces(
-            hovertemplate='<b>%{customdata[0]}</b><br>' + 'Country Code: %{customdata[3]}<br>' + f'{title} {context}:' + '%{customdata[2]}'
-        )
-    return fig
+    trace = map_figs[value].data[0]
+    patch = Patch()
+    patch['data'][0]['z'] = trace.z
+    if trace.customdata is not None:
+        patch['data'][0]['customdata'] = trace.customdata
+    patch['data'][0]['colorscale'] = trace.colorscale
+    patch['data'][0]['colorbar'] = trace.colorbar.to_plotly_json()
+    patch['data'][0]['hovertemplate'] = trace.hovertemplate
+    patch['layout']['title']['text'] = map_figs[value].layout.title.text
+    return patch
 
 
 # Define the app callback for line chart
@@ -274,53 +431,10 @@ def update_line_chart(click_data, iss, ser_lev, res_type, year_input):
         Returns.
             line_fig (plot): line chart of the selected issue
     '''
-    # break up the issue dictionary
-    selected = issue[iss]
-    line_df = selected[0].copy()
-    title = selected[1]
-
-    # break up the service level dictionary
-    serv = services[ser_lev]
-    if iss != 'gdp':
-        fil_cols = ['iso3', 'year', 'country'] + [col for col in line_df.columns if
-                                                  any([x in col for x in serv]) and col.endswith(res_type)]
-        line_df = line_df[fil_cols]
-
     # get the data for the selected country
     if click_data:
         location = click_data["points"][0]["location"]
-        filtered_df = line_df[line_df["iso3"] == location]
-        new_dict = {string: service_map[key] for string in filtered_df.columns for key in service_map.keys() if
-                    key in string}
-        filtered_df = filtered_df.rename(columns=new_dict)
-
-        # assign sun years to be greater than or = min val and less than or = max val
-        filtered_df = filtered_df[(filtered_df['year'] >= year_input[0]) & (filtered_df['year'] <= year_input[1])]
-
-        # build the line chart
-        line_fig = px.line(
-            filtered_df,
-            x="year",
-            y=filtered_df.columns[3:],
-            height=400,
-        )
-
-        # format the line chart
-        line_fig.update_layout(
-            title=f"<b>{filtered_df['country'].iloc[0]} -- Year by Year</b>",
-            title_x=0.5,
-            margin=dict(l=30, r=30, t=60, b=0),
-            xaxis_title="Year",
-        )
-        line_fig.for_each_trace(
-            lambda trace: trace.update(visible='legendonly') if trace.name != filtered_df.columns[3] else ())
-
-        # gdp specific formatting
-        if iss != 'gdp':
-            line_fig.update_layout(
-                yaxis_title=f"{title} Coverage (%)",
-            )
-
+        line_fig = line_figure(location, iss, ser_lev, res_type, year_input[0], year_input[1])
     else:
         line_fig = go.Figure()
 